@@ -1,163 +1,325 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
 import os
+import shutil
+import pathlib
 import argparse
-from urllib.parse import unquote
+from urllib.parse import unquote, urlencode
 import time
 import json
+import hashlib
+import functools
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+import threading
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+logger = logging.getLogger(__name__)
 
 USER_AGENT = "WikimediaScraperBot/1.0 (https://github.com/heysarver/wikimedia-scraper)"
 
-def get_files_in_category(category, license_types=["any"], limit=500):
+# One pooled session for the whole run so API and upload requests reuse
+# keep-alive connections instead of paying a TCP+TLS handshake each time.
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": USER_AGENT})
+atexit.register(SESSION.close)
+
+def mount_adapter(pool_maxsize=64):
+    # Each download worker needs its own pooled connection, otherwise urllib3
+    # discards the extras and logs "Connection pool is full".
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                          respect_retry_after_header=True)
+    )
+    SESSION.mount("https://", adapter)
+    SESSION.mount("http://", adapter)
+
+mount_adapter()
+
+CACHE_DIR = os.path.expanduser("~/.cache/wm-scraper")
+MAXLAG = 5
+MAXLAG_RETRIES = 5
+MAXLAG_DELAY = 5
+# Largest gcmlimit the API allows for clients without the apihighlimits right.
+API_MAX_LIMIT = 500
+
+def write_atomic(path, payload):
+    # Write to a temporary file beside path and rename it into place so
+    # readers, including concurrent runs, never see a half-written file.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def cached_get(url, params, ttl=3600):
+    # API responses are cached on disk keyed by the full query, so re-running
+    # the same category only hits Wikimedia once the TTL has expired.
+    key = hashlib.sha1((url + "?" + urlencode(sorted(params.items()))).encode("utf-8")).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"{key}.json")
+    if ttl > 0 and os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < ttl:
+        try:
+            with open(cache_path, "rb") as f:
+                return json_loads(f.read())
+        except (OSError, json.JSONDecodeError) as e:
+            logger.debug("Ignoring unreadable cache entry %s: %s", cache_path, e)
+
+    for attempt in range(MAXLAG_RETRIES):
+        response = SESSION.get(url, params=params, timeout=30)
+        response.raise_for_status()
+        data = json_loads(response.content)
+        # Requests sent with maxlag are refused while the database replicas
+        # are lagging; wait as long as the server asks and try again.
+        if data.get("error", {}).get("code") != "maxlag" or attempt == MAXLAG_RETRIES - 1:
+            break
+        # Retry-After may also be an HTTP date; fall back to the default
+        # delay for anything that isn't a plain number of seconds.
+        try:
+            retry_after = max(int(response.headers.get("Retry-After", MAXLAG_DELAY)), 0)
+        except ValueError:
+            retry_after = MAXLAG_DELAY
+        logger.debug("Server lagged, retrying in %d seconds", retry_after)
+        time.sleep(retry_after)
+    if ttl > 0 and "error" not in data:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            write_atomic(cache_path, json_dumps(data))
+        except OSError as e:
+            logger.debug("Could not write cache entry %s: %s", cache_path, e)
+    return data
+
+def get_files_in_category(category, norm_licenses=(), limit=500, min_dimension=None, batch_size=50, cache_ttl=3600, thumb_width=None):
     base_url = "https://commons.wikimedia.org/w/api.php"
-    params = {
+    # A single generator query returns titles, URLs, dimensions and license
+    # metadata together, so no follow-up imageinfo calls are needed.
+    base_params = {
         "action": "query",
         "format": "json",
-        "list": "categorymembers",
-        "cmtitle": f"Category:{category}",
-        "cmtype": "file",
-        "cmlimit": min(50, limit)
+        "formatversion": 2,
+        "generator": "categorymembers",
+        "gcmtitle": f"Category:{category}",
+        "gcmtype": "file",
+        "gcmlimit": min(batch_size, limit, API_MAX_LIMIT),
+        "prop": "imageinfo",
+        "iiprop": "url|size|extmetadata",
+        "maxlag": MAXLAG
     }
-    headers = {"User-Agent": USER_AGENT}
+    # With iiurlwidth the API also returns a server-rendered thumbnail URL,
+    # which is far smaller than the original and already cached upstream.
+    if thumb_width:
+        base_params["iiurlwidth"] = thumb_width
+    params = base_params
 
-    files = []
-    total_fetched = 0
+    found = 0
     api_calls = 0
 
-    while total_fetched < limit:
+    while found < limit:
         api_calls += 1
-        start_time = time.time()
-        response = requests.get(base_url, params=params, headers=headers, timeout=30)
-        end_time = time.time()
-        print(f"API call {api_calls} took {end_time - start_time:.2f} seconds")
-        
-        data = response.json()
-
-        if "query" not in data or "categorymembers" not in data["query"]:
-            print(f"Error in API response: {data}")
+        # Only time calls when the result will actually be logged.
+        start_time = time.perf_counter() if logger.isEnabledFor(logging.DEBUG) else None
+        try:
+            data = cached_get(base_url, params, cache_ttl)
+        except (requests.RequestException, json.JSONDecodeError) as e:
+            logger.error("Error fetching category members: %s", e)
             break
+        if start_time is not None:
+            logger.debug("API call %d took %.2f seconds", api_calls, time.perf_counter() - start_time)
+
+        if "error" in data:
+            logger.error("Error in API response: %s", data["error"])
+            break
+
+        # formatversion=2 returns pages as a list rather than a dict keyed
+        # by page id.
+        for page in data.get("query", {}).get("pages", []):
+            # Pages whose imageinfo was deferred by continuation show up
+            # again in the next response with it filled in.
+            if not (imageinfo := page.get("imageinfo")):
+                continue
+            image_info = imageinfo[0]
+            if norm_licenses and not license_matches(image_info, norm_licenses):
+                continue
 
-        batch = [item["title"] for item in data["query"]["categorymembers"]]
-        if license_types != ["any"]:
-            batch = check_licenses_batch(batch, license_types)
+            file_width = image_info["width"]
+            file_height = image_info["height"]
+            if min_dimension is not None and file_width < min_dimension and file_height < min_dimension:
+                logger.debug("Skipped: %s (Dimensions: %dx%d)", page["title"], file_width, file_height)
+                continue
 
-        files.extend(batch[:limit - total_fetched])
-        total_fetched += len(batch)
+            file_info = {
+                "title": page["title"],
+                "url": image_info["url"],
+                "size": image_info["size"],
+                "width": file_width,
+                "height": file_height
+            }
+            # Originals narrower than the requested width come back with the
+            # original URL as thumburl; files without a thumburl keep the original.
+            if "thumburl" in image_info and image_info["thumburl"] != image_info["url"]:
+                file_info.update({
+                    "url": image_info["thumburl"],
+                    "size": None,
+                    "width": image_info["thumbwidth"],
+                    "height": image_info["thumbheight"]
+                })
+            yield file_info
+            found += 1
+            if found >= limit:
+                break
 
-        print(f"Total files found so far: {total_fetched}")
+        logger.debug("Total files found so far: %d", found)
 
-        if "continue" in data and total_fetched < limit:
-            params["cmcontinue"] = data["continue"]["cmcontinue"]
+        if "continue" in data and found < limit:
+            # Each continue block is complete on its own; merging it into the
+            # previous params would resend stale keys such as iicontinue.
+            params = {**base_params, **data["continue"]}
         else:
             break
 
-    return files[:limit]
+def license_matches(image_info, norm_licenses):
+    license_short_name = image_info.get("extmetadata", {}).get("LicenseShortName", {}).get("value")
+    return bool(license_short_name) and license_name_matches(license_short_name, norm_licenses)
 
-def check_licenses_batch(file_titles, license_types):
-    base_url = "https://commons.wikimedia.org/w/api.php"
-    params = {
-        "action": "query",
-        "format": "json",
-        "prop": "imageinfo",
-        "iiprop": "extmetadata",
-        "titles": "|".join(file_titles)
-    }
-    headers = {"User-Agent": USER_AGENT}
-    
-    start_time = time.time()
-    try:
-        response = requests.get(base_url, params=params, headers=headers, timeout=30)
-        response.raise_for_status()
-        
-        print(f"Response status code: {response.status_code}")
-        print(f"Response headers: {response.headers}")
-        
-        try:
-            data = response.json()
-        except json.JSONDecodeError as e:
-            print(f"JSONDecodeError: {e}")
-            print(f"Response content: {response.text[:1000]}...")
-            return []
-        
-    except requests.RequestException as e:
-        print(f"Request failed: {e}")
-        return []
-
-    end_time = time.time()
-    print(f"Batch license check for {len(file_titles)} files took {end_time - start_time:.2f} seconds")
-
-    valid_files = []
-    if "query" in data and "pages" in data["query"]:
-        for page in data["query"]["pages"].values():
-            if "imageinfo" in page and "extmetadata" in page["imageinfo"][0]:
-                metadata = page["imageinfo"][0]["extmetadata"]
-                if "LicenseShortName" in metadata:
-                    license_short_name = metadata["LicenseShortName"]["value"]
-                    if any(normalize_string(lt) in normalize_string(license_short_name) for lt in license_types):
-                        valid_files.append(page["title"])
-
-    return valid_files
+# Commons uses a small fixed set of LicenseShortName values, so the substring
+# scan runs once per distinct name and every later page is a cache hit.
+@functools.lru_cache(maxsize=1024)
+def license_name_matches(license_short_name, norm_licenses):
+    norm_name = normalize_string(license_short_name)
+    return any(nl in norm_name for nl in norm_licenses)
+
+class _NormalizeTable(dict):
+    # str.translate table that drops everything except alphanumerics and
+    # underscores; entries are filled in lazily the first time a code point
+    # is seen, so non-ASCII letters are kept exactly as isalnum() would.
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        self[codepoint] = char if char.isalnum() or char == "_" else None
+        return self[codepoint]
 
+_NORMALIZE_TABLE = _NormalizeTable()
+
+@functools.lru_cache(maxsize=1024)
 def normalize_string(s):
-    ns = s.lower().replace(" ", "_")
-    ns = ''.join(e for e in ns if e.isalnum() or e == "_")
-    return ns
+    return s.lower().replace(" ", "_").translate(_NORMALIZE_TABLE)
 
-def check_dimensions_batch(file_titles, min_dimension=None):
-    base_url = "https://commons.wikimedia.org/w/api.php"
-    params = {
-        "action": "query",
-        "format": "json",
-        "prop": "imageinfo",
-        "iiprop": "url|size",
-        "titles": "|".join(file_titles)
-    }
-    headers = {"User-Agent": USER_AGENT}
-    
-    start_time = time.time()
+ETAGS_FILE = ".etags.json"
+OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+_etags_lock = threading.Lock()
+
+def load_etags(output_dir):
+    etags_path = os.path.join(output_dir, ETAGS_FILE)
+    if not os.path.exists(etags_path):
+        return {}
     try:
-        response = requests.get(base_url, params=params, headers=headers, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-    except (requests.RequestException, json.JSONDecodeError) as e:
-        print(f"Error in batch dimension check: {e}")
-        return []
-
-    end_time = time.time()
-    print(f"Batch dimension check for {len(file_titles)} files took {end_time - start_time:.2f} seconds")
-
-    valid_files = []
-    if "query" in data and "pages" in data["query"]:
-        for page in data["query"]["pages"].values():
-            if "imageinfo" in page and page["imageinfo"]:
-                file_info = page["imageinfo"][0]
-                file_width = file_info["width"]
-                file_height = file_info["height"]
-                
-                if min_dimension is None or file_width >= min_dimension or file_height >= min_dimension:
-                    valid_files.append({
-                        "title": page["title"],
-                        "url": file_info["url"],
-                        "width": file_width,
-                        "height": file_height
-                    })
-                else:
-                    print(f"Skipped: {page['title']} (Dimensions: {file_width}x{file_height})")
-
-    return valid_files
-
-def download_file(file_info, output_dir):
-    start_time = time.time()
-    file_name = unquote(file_info["url"].split("/")[-1])
-    
-    headers = {"User-Agent": USER_AGENT}
-    response = requests.get(file_info["url"], headers=headers)
-    if response.status_code == 200:
-        with open(os.path.join(output_dir, file_name), "wb") as f:
-            f.write(response.content)
-        end_time = time.time()
-        print(f"Downloaded: {file_name} (Dimensions: {file_info['width']}x{file_info['height']}) in {end_time - start_time:.2f} seconds")
-    else:
-        print(f"Failed to download: {file_name}. Status code: {response.status_code}")
+        with open(etags_path, "rb") as f:
+            return json_loads(f.read())
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning("Ignoring unreadable %s: %s", etags_path, e)
+        return {}
+
+def save_etags(output_dir, etags):
+    # Runs that never download a thumbnail leave no sidecar behind.
+    if not etags:
+        return
+    write_atomic(os.path.join(output_dir, ETAGS_FILE), json_dumps(etags))
+
+def download_file(file_info, output_dir, etags=None, dir_fd=None):
+    start_time = time.perf_counter() if logger.isEnabledFor(logging.DEBUG) else None
+    file_name = unquote(file_info["url"].rpartition("/")[2])
+    # With a directory fd every stat/open/rename below is resolved relative
+    # to it (openat and friends) instead of walking the full path each time.
+    file_path = file_name if dir_fd is not None else output_dir / file_name
+    # Downloads land in a hidden temp file beside the target and are renamed
+    # over it only once complete, so an interrupted or failed transfer never
+    # leaves a truncated file or clobbers the previous good copy.
+    tmp_name = f".{file_name}.{uuid.uuid4().hex[:8]}.part"
+    tmp_path = tmp_name if dir_fd is not None else output_dir / tmp_name
+    headers = {}
+    try:
+        file_size = os.stat(file_path, dir_fd=dir_fd).st_size
+    except FileNotFoundError:
+        file_size = None
+    if file_size is not None:
+        # A file with the expected byte count is a finished earlier download;
+        # a size mismatch means it was truncated or has changed upstream.
+        expected_size = file_info.get("size")
+        if expected_size:
+            if file_size == expected_size:
+                logger.debug("Already downloaded: %s", file_name)
+                return
+        # Thumbnails have no known size, so revalidate them with the ETag
+        # from the previous download; a 304 costs only the headers.
+        elif etags is not None and file_name in etags:
+            headers["If-None-Match"] = etags[file_name]
+        else:
+            logger.debug("Already downloaded: %s", file_name)
+            return
+
+    # Stream straight to disk so only a fixed-size buffer is held in memory,
+    # regardless of how large the original is.
+    opened = False
+    try:
+        with SESSION.get(file_info["url"], headers=headers, stream=True, timeout=60) as response:
+            if response.status_code == 304:
+                logger.debug("Not modified: %s", file_name)
+                return
+            if response.status_code != 200:
+                logger.warning("Failed to download: %s. Status code: %d", file_name, response.status_code)
+                return
+            # Reading response.raw bypasses requests' decoding, so let urllib3
+            # undo any Content-Encoding before the bytes hit the file.
+            response.raw.decode_content = True
+            fd = os.open(tmp_path, OPEN_FLAGS, 0o666, dir_fd=dir_fd)
+            opened = True
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(response.raw, f, 1024 * 1024)
+            os.replace(tmp_path, file_path, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+            opened = False
+            # Only thumbnails are revalidated by ETag; originals are checked
+            # against their known size instead.
+            if etags is not None and file_info.get("size") is None and "ETag" in response.headers:
+                with _etags_lock:
+                    etags[file_name] = response.headers["ETag"]
+    except (requests.RequestException, Urllib3HTTPError, OSError) as e:
+        logger.warning("Failed to download: %s. %s", file_name, e)
+        # Only the temp file is ever partial; the target is left untouched.
+        if opened:
+            try:
+                os.unlink(tmp_path, dir_fd=dir_fd)
+            except FileNotFoundError:
+                pass
+        return
+
+    if start_time is not None:
+        logger.debug("Downloaded: %s (Dimensions: %dx%d) in %.2f seconds",
+                     file_name, file_info["width"], file_info["height"], time.perf_counter() - start_time)
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 def main():
     parser = argparse.ArgumentParser(description="Download images from Wikimedia Commons categories.")
@@ -166,43 +328,81 @@ def main():
     parser.add_argument("--output", required=False, help="Output directory", default="output")
     parser.add_argument("--limit", required=False, help="Maximum number of files to scrape", default=500, type=int)
     parser.add_argument("--min-dimension", required=False, help="Minimum width or height of images to download", type=int)
-    parser.add_argument("--batch-size", required=False, help="Number of files to process in each batch", default=50, type=int)
+    parser.add_argument("--batch-size", required=False, help="Number of category members to request per API call", default=50, type=int)
+    parser.add_argument("--threads", "--workers", dest="threads", required=False, help="Number of concurrent downloads", default=10, type=positive_int)
+    parser.add_argument("--thumb-width", required=False, help="Download Wikimedia's pre-scaled thumbnail at this width instead of the original", type=int)
+    parser.add_argument("--verbose", action="store_true", help="Log every API call and download")
+    parser.add_argument("--cache-ttl", required=False, help="Seconds to reuse cached API responses (0 disables the cache)", default=3600, type=int)
     args = parser.parse_args()
 
+    # Workers only enqueue records; a single listener thread does the
+    # formatting and terminal writes so downloads never block on stdout.
+    log_queue = queue.Queue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[QueueHandler(log_queue)])
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
     category = args.category
     license_types = [lt.strip().lower() for lt in args.license.split(",")]
-    output_dir = args.output
+    # Normalised once here; an empty tuple means no license filtering.
+    norm_licenses = () if license_types == ["any"] else tuple(normalize_string(lt) for lt in license_types)
+    output_dir = pathlib.Path(args.output)
     file_limit = args.limit
     min_dimension = args.min_dimension
     batch_size = args.batch_size
+    threads = args.threads
+    cache_ttl = args.cache_ttl
+    thumb_width = args.thumb_width
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    mount_adapter(threads)
     
-    print(f"Fetching files from category: {category}")
-    print(f"License filter: {', '.join(license_types)}")
-    print(f"Output directory: {output_dir}")
-    print(f"File limit: {file_limit}")
-    print(f"Batch size: {batch_size}")
+    logger.info("Fetching files from category: %s", category)
+    logger.info("License filter: %s", ", ".join(license_types))
+    logger.info("Output directory: %s", output_dir)
+    logger.info("File limit: %d", file_limit)
+    logger.info("Batch size: %d", batch_size)
+    logger.info("Download threads: %d", threads)
     if min_dimension:
-        print(f"Minimum dimension: {min_dimension}")
+        logger.info("Minimum dimension: %d", min_dimension)
     else:
-        print("No minimum dimension set (downloading all files)")
+        logger.info("No minimum dimension set (downloading all files)")
+    if thumb_width:
+        logger.info("Thumbnail width: %d", thumb_width)
     
-    start_time = time.time()
-    files = get_files_in_category(category, license_types, file_limit)
-    end_time = time.time()
-    print(f"Found {len(files)} files matching criteria in {end_time - start_time:.2f} seconds")
-
-    for i in range(0, len(files), batch_size):
-        batch = files[i:i+batch_size]
-        print(f"Processing batch {i//batch_size + 1} of {(len(files)-1)//batch_size + 1}")
-        valid_files = check_dimensions_batch(batch, min_dimension)
-        
-        for file_info in valid_files:
-            download_file(file_info, output_dir)
+    etags = load_etags(output_dir)
+    dir_fd = None
+    # download_file stats, opens, renames and removes relative to the fd, so
+    # every one of those calls must accept dir_fd before it is used.
+    if {os.open, os.stat, os.rename, os.unlink} <= os.supports_dir_fd and hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(output_dir, os.O_RDONLY | os.O_DIRECTORY)
+    start_time = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # Files are submitted as each page of results arrives, so downloads
+            # for one page overlap with the API call for the next.
+            files = get_files_in_category(category, norm_licenses, file_limit, min_dimension, batch_size, cache_ttl, thumb_width)
+            futures = [executor.submit(download_file, file_info, output_dir, etags, dir_fd) for file_info in files]
+            logger.info("Found %d files matching criteria in %.2f seconds", len(futures), time.perf_counter() - start_time)
+            for index, future in enumerate(as_completed(futures), 1):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error("Download failed: %s", e)
+                logger.debug("Finished %d of %d downloads", index, len(futures))
+    finally:
+        # The executor has joined its workers by now, so nothing still uses
+        # the fd, and ETags from an interrupted run are kept.
+        if dir_fd is not None:
+            os.close(dir_fd)
+        save_etags(output_dir, etags)
     
-    print("Download complete.")
+    logger.info("Download complete.")
 
 if __name__ == '__main__':
     main()